@@ -17,25 +17,24 @@
 
 """Send an A/B update to an Android device over adb."""
 
-from __future__ import print_function
-from __future__ import absolute_import
-
 import argparse
 import binascii
+import email.utils
+import errno
+import functools
 import hashlib
+import http.server as BaseHTTPServer
 import logging
 import os
+import shlex
 import socket
 import subprocess
 import sys
-import struct
 import tempfile
 import threading
 import xml.etree.ElementTree
 import zipfile
 
-from six.moves import BaseHTTPServer
-
 import update_payload.payload
 
 
@@ -48,34 +47,50 @@ PAYLOAD_KEY_PATH = '/etc/update_engine/update-payload-key.pub.pem'
 # The port on the device that update_engine should connect to.
 DEVICE_PORT = 1234
 
+# Payload metadata larger than this is staged in a temporary file and pushed
+# with "adb push" instead of being piped to the device from memory.
+METADATA_IN_MEMORY_LIMIT = 100 * 1024 * 1024
+
 
-def CopyFileObjLength(fsrc, fdst, buffer_size=128 * 1024, copy_length=None):
+def CopyFileObjLength(fsrc, fdst, buffer_size=1024 * 1024, copy_length=None):
   """Copy from a file object to another.
 
   This function is similar to shutil.copyfileobj except that it allows to copy
   less than the full source file.
 
   Args:
-    fsrc: source file object where to read from.
+    fsrc: source file object where to read from. It must support readinto().
     fdst: destination file object where to write to.
-    buffer_size: size of the copy buffer in memory.
+    buffer_size: size of the copy buffer in memory. Larger buffers mean fewer
+        read/write round trips for multi-GB payloads, at the cost of holding
+        that much memory per copy in flight.
     copy_length: maximum number of bytes to copy, or None to copy everything.
 
   Returns:
     the number of bytes copied.
   """
+  # Reuse a single buffer for the whole copy instead of allocating a new bytes
+  # object per chunk, and pick the loop once instead of checking copy_length
+  # on every chunk.
+  view = memoryview(bytearray(buffer_size))
+  readinto = fsrc.readinto
+  write = fdst.write
   copied = 0
-  while True:
-    chunk_size = buffer_size
-    if copy_length is not None:
-      chunk_size = min(chunk_size, copy_length - copied)
-      if not chunk_size:
+  if copy_length is None:
+    while True:
+      n = readinto(view)
+      if not n:
         break
-    buf = fsrc.read(chunk_size)
-    if not buf:
+      write(view[:n])
+      copied += n
+    return copied
+
+  while copied < copy_length:
+    n = readinto(view[:min(buffer_size, copy_length - copied)])
+    if not n:
       break
-    fdst.write(buf)
-    copied += len(buf)
+    write(view[:n])
+    copied += n
   return copied
 
 
@@ -95,10 +110,12 @@ class AndroidOTAPackage(object):
   SECONDARY_OTA_PAYLOAD_PROPERTIES_TXT = 'secondary/payload_properties.txt'
   PAYLOAD_MAGIC_HEADER = b'CrAU'
 
-  def __init__(self, otafilename, secondary_payload=False):
+  def __init__(self, otafilename, secondary_payload=False, zfp=None):
     self.otafilename = otafilename
 
-    otazip = zipfile.ZipFile(otafilename, 'r')
+    # Reuse the caller's handle on the package if there is one, so the central
+    # directory is only parsed once.
+    otazip = zfp if zfp else zipfile.ZipFile(otafilename, 'r')
     payload_entry = (self.SECONDARY_OTA_PAYLOAD_BIN if secondary_payload else
                      self.OTA_PAYLOAD_BIN)
     payload_info = otazip.getinfo(payload_entry)
@@ -109,31 +126,29 @@ class AndroidOTAPackage(object):
           payload_info.compress_type)
     # Don't use len(payload_info.extra). Because that returns size of extra
     # fields in central directory. We need to look at local file directory,
-    # as these two might have different sizes.
-    with open(otafilename, "rb") as fp:
-      fp.seek(payload_info.header_offset)
-      data = fp.read(zipfile.sizeFileHeader)
-      fheader = struct.unpack(zipfile.structFileHeader, data)
-      # Last two fields of local file header are filename length and
-      # extra length
-      filename_len = fheader[-2]
-      extra_len = fheader[-1]
-      self.offset = payload_info.header_offset
-      self.offset += zipfile.sizeFileHeader
-      self.offset += filename_len + extra_len
-      self.size = payload_info.file_size
-      fp.seek(self.offset)
-      payload_header = fp.read(4)
-      if payload_header != self.PAYLOAD_MAGIC_HEADER:
-        logging.warning(
-            "Invalid header, expected %s, got %s."
-            "Either the offset is not correct, or payload is corrupted",
-            binascii.hexlify(self.PAYLOAD_MAGIC_HEADER),
-            binascii.hexlify(payload_header))
-
-    property_entry = (self.SECONDARY_OTA_PAYLOAD_PROPERTIES_TXT if
-                      secondary_payload else self.OTA_PAYLOAD_PROPERTIES_TXT)
-    self.properties = otazip.read(property_entry)
+    # as these two might have different sizes. ZipFile.open() already parses
+    # the local file header and records where the entry data starts.
+    with otazip.open(payload_entry) as payload_fp:
+      # pylint: disable=protected-access
+      self.offset = payload_fp._orig_compress_start
+      payload_header = payload_fp.read(4)
+    self.size = payload_info.file_size
+    if payload_header != self.PAYLOAD_MAGIC_HEADER:
+      logging.warning(
+          "Invalid header, expected %s, got %s."
+          "Either the offset is not correct, or payload is corrupted",
+          binascii.hexlify(self.PAYLOAD_MAGIC_HEADER),
+          binascii.hexlify(payload_header))
+
+    self._otazip = otazip
+    self._property_entry = (
+        self.SECONDARY_OTA_PAYLOAD_PROPERTIES_TXT if secondary_payload else
+        self.OTA_PAYLOAD_PROPERTIES_TXT)
+
+  @functools.cached_property
+  def properties(self):
+    """The payload properties, read from the package on first access."""
+    return self._otazip.read(self._property_entry)
 
 
 class UpdateHandler(BaseHTTPServer.BaseHTTPRequestHandler):
@@ -142,8 +157,17 @@ class UpdateHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   Attributes:
     serving_payload: path to the only payload file we are serving.
     serving_range: the start offset and size tuple of the payload.
+    serving_fd: file descriptor of serving_payload, opened once per server.
+    last_modified: Last-Modified header value for serving_payload.
   """
 
+  # Set per server by ServerThread on a subclass of this handler. The
+  # serving_payload check in do_GET/do_POST rejects requests while unset.
+  serving_payload = None
+  serving_range = (0, 0)
+  serving_fd = None
+  last_modified = None
+
   @staticmethod
   def _parse_range(range_str, file_size):
     """Parse an HTTP range string.
@@ -180,11 +204,6 @@ class UpdateHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       self.send_error(500, 'No serving payload set')
       return
 
-    try:
-      f = open(self.serving_payload, 'rb')
-    except IOError:
-      self.send_error(404, 'File not found')
-      return
     # Handle the range request.
     if 'Range' in self.headers:
       self.send_response(206)
@@ -204,13 +223,32 @@ class UpdateHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                      '/' + str(end_range - start_range))
     self.send_header('Content-Length', end_range - start_range)
 
-    stat = os.fstat(f.fileno())
-    self.send_header('Last-Modified', self.date_time_string(stat.st_mtime))
+    self.send_header('Last-Modified', self.last_modified)
     self.send_header('Content-type', 'application/octet-stream')
     self.end_headers()
 
-    f.seek(serving_start + start_range)
-    CopyFileObjLength(f, self.wfile, copy_length=end_range - start_range)
+    # Flush the buffered headers before handing the socket to sendfile() so
+    # the payload bytes are not written ahead of them.
+    self.wfile.flush()
+    offset = serving_start + start_range
+    remaining = end_range - start_range
+    try:
+      while remaining:
+        sent = os.sendfile(self.wfile.fileno(), self.serving_fd, offset,
+                           remaining)
+        if not sent:
+          break
+        offset += sent
+        remaining -= sent
+    except OSError as e:
+      # sendfile() is not supported for every file/socket combination; fall
+      # back to copying the rest of the range in userspace.
+      if e.errno != errno.EINVAL:
+        raise
+      with open(self.serving_payload, 'rb') as f:
+        f.seek(offset)
+        CopyFileObjLength(f, self.wfile, buffer_size=1024 * 1024,
+                          copy_length=remaining)
 
   def do_POST(self):  # pylint: disable=invalid-name
     """Reply with the omaha response xml."""
@@ -290,13 +328,37 @@ class UpdateHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 class ServerThread(threading.Thread):
   """A thread for serving HTTP requests."""
 
-  def __init__(self, ota_filename, serving_range):
+  def __init__(self, ota_filename, serving_range, ota_stat=None):
     threading.Thread.__init__(self)
-    # serving_payload and serving_range are class attributes and the
-    # UpdateHandler class is instantiated with every request.
-    UpdateHandler.serving_payload = ota_filename
-    UpdateHandler.serving_range = serving_range
-    self._httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), UpdateHandler)
+    # The payload doesn't change while serving, so open it once and share the
+    # descriptor. sendfile() takes an explicit offset, so concurrent requests
+    # don't step on each other's file position.
+    self._serving_fd = os.open(
+        ota_filename, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+    if ota_stat is None:
+      ota_stat = os.fstat(self._serving_fd)
+    # The handler class is instantiated with every request, so bind the
+    # serving state to a subclass owned by this server rather than to
+    # UpdateHandler itself, which every server would share.
+    handler = type('BoundUpdateHandler', (UpdateHandler,), {
+        'serving_payload': ota_filename,
+        'serving_range': serving_range,
+        'serving_fd': self._serving_fd,
+        # Same format as BaseHTTPRequestHandler.date_time_string().
+        'last_modified': email.utils.formatdate(ota_stat.st_mtime,
+                                                usegmt=True),
+    })
+    # Serve each request on its own thread so concurrent range requests don't
+    # queue behind one another.
+    try:
+      self._httpd = BaseHTTPServer.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                       handler)
+    except:
+      os.close(self._serving_fd)
+      raise
+    # Keep the handler threads joinable so StopServer can wait for in-flight
+    # transfers to finish before it closes the shared descriptor.
+    self._httpd.daemon_threads = False
     self.port = self._httpd.server_port
 
   def run(self):
@@ -308,26 +370,42 @@ class ServerThread(threading.Thread):
 
   def StopServer(self):
     self._httpd.shutdown()
-    self._httpd.socket.close()
+    # server_close() also joins the handler threads, so nothing is still
+    # reading serving_fd when it is closed below.
+    self._httpd.server_close()
+    os.close(self._serving_fd)
 
 
-def StartServer(ota_filename, serving_range):
-  t = ServerThread(ota_filename, serving_range)
+def StartServer(ota_filename, serving_range, ota_stat=None):
+  t = ServerThread(ota_filename, serving_range, ota_stat)
   t.start()
   return t
 
 
-def AndroidUpdateCommand(ota_filename, secondary, payload_url, extra_headers):
+def AndroidUpdateCommand(ota_filename, secondary, payload_url, extra_headers,
+                         zfp=None):
   """Return the command to run to start the update in the Android device."""
-  ota = AndroidOTAPackage(ota_filename, secondary)
-  headers = ota.properties
-  headers += b'USER_AGENT=Dalvik (something, something)\n'
-  headers += b'NETWORK_ID=0\n'
-  headers += extra_headers.encode()
-
+  ota = AndroidOTAPackage(ota_filename, secondary, zfp)
+  headers = b'\n'.join(filter(None, [
+      ota.properties.rstrip(b'\n'),
+      b'USER_AGENT=Dalvik (something, something)',
+      b'NETWORK_ID=0',
+      extra_headers.encode()])) + b'\n'
+
+  # subprocess encodes str arguments with os.fsencode(), so decoding with
+  # os.fsdecode() round-trips the headers byte for byte, even if the
+  # properties aren't valid UTF-8.
   return ['update_engine_client', '--update', '--follow',
           '--payload=%s' % payload_url, '--offset=%d' % ota.offset,
-          '--size=%d' % ota.size, '--headers="%s"' % headers.decode()]
+          '--size=%d' % ota.size, '--headers="%s"' % os.fsdecode(headers)]
+
+
+def RootShellCommand(shell_cmds):
+  """Return an adb command running |shell_cmds| in one root shell.
+
+  The commands are chained with "&&", so the first failure stops the rest.
+  """
+  return ['shell', 'su', '0', 'sh', '-c', shlex.quote(' && '.join(shell_cmds))]
 
 
 def OmahaUpdateCommand(omaha_url):
@@ -363,7 +441,8 @@ class AdbHost(object):
       subprocess.CalledProcessError on command exit != 0.
     """
     command = self._command_prefix + command
-    logging.info('Running: %s', ' '.join(str(x) for x in command))
+    if logging.getLogger().isEnabledFor(logging.INFO):
+      logging.info('Running: %s', ' '.join(map(str, command)))
     p = subprocess.Popen(command, universal_newlines=True)
     p.wait(timeout_seconds)
     return p.returncode
@@ -381,24 +460,50 @@ class AdbHost(object):
       subprocess.CalledProcessError on command exit != 0.
     """
     command = self._command_prefix + command
-    logging.info('Running: %s', ' '.join(str(x) for x in command))
+    if logging.getLogger().isEnabledFor(logging.INFO):
+      logging.info('Running: %s', ' '.join(map(str, command)))
     return subprocess.check_output(command, universal_newlines=True)
 
+  def adb_input(self, command, data, timeout_seconds: float = None):
+    """Run an ADB command like "adb shell cat" feeding it data on stdin.
+
+    Args:
+      command: list of strings containing command and arguments to run
+      data: bytes to write to the program's standard input.
+      timeout_seconds: seconds to wait for the program, or None to wait
+          indefinitely.
 
-def PushMetadata(dut, otafile, metadata_path):
-  payload = update_payload.Payload(otafile)
+    Returns:
+      the program's return code.
+    """
+    command = self._command_prefix + command
+    if logging.getLogger().isEnabledFor(logging.INFO):
+      logging.info('Running: %s', ' '.join(map(str, command)))
+    return subprocess.run(command, input=data, check=False,
+                          timeout=timeout_seconds).returncode
+
+
+def PushMetadata(dut, zfp, metadata_path):
+  payload = update_payload.Payload(zfp)
   payload.Init()
-  with tempfile.TemporaryDirectory() as tmpdir:
-    with zipfile.ZipFile(otafile, "r") as zfp:
+  with zfp.open("payload.bin") as payload_fp:
+    # Only extract the first |data_offset| bytes from the payload.
+    # This is because allocateSpaceForPayload only needs to see
+    # the manifest, not the entire payload.
+    # Extracting the entire payload works, but is slow for full
+    # OTA.
+    if payload.data_offset <= METADATA_IN_MEMORY_LIMIT:
+      # Pipe the metadata straight to the device instead of staging it in a
+      # temporary file for "adb push".
+      metadata = payload_fp.read(payload.data_offset)
+      return dut.adb_input(
+          ["shell", "cat > %s" % shlex.quote(metadata_path)], metadata) == 0
+
+    with tempfile.TemporaryDirectory() as tmpdir:
       extracted_path = os.path.join(tmpdir, "payload.bin")
-      with zfp.open("payload.bin") as payload_fp, \
-              open(extracted_path, "wb") as output_fp:
-          # Only extract the first |data_offset| bytes from the payload.
-          # This is because allocateSpaceForPayload only needs to see
-          # the manifest, not the entire payload.
-          # Extracting the entire payload works, but is slow for full
-          # OTA.
-        output_fp.write(payload_fp.read(payload.data_offset))
+      with open(extracted_path, "wb") as output_fp:
+        CopyFileObjLength(payload_fp, output_fp, buffer_size=1024 * 1024,
+                          copy_length=payload.data_offset)
 
       return dut.adb([
           "push",
@@ -441,6 +546,31 @@ def main():
   logging.basicConfig(
       level=logging.WARNING if args.no_verbose else logging.INFO)
 
+  # Open the package once and share the handle, rather than reparsing its
+  # central directory for every step that looks inside it.
+  try:
+    zfp = zipfile.ZipFile(args.otafile)
+  except zipfile.BadZipFile:
+    # A raw payload, which only the Omaha flow can serve.
+    if args.allocate_only or args.verify_only:
+      parser.error('--allocate-only and --verify-only need an OTA package '
+                   '(.zip), not a raw payload')
+    return UpdateDevice(args, None)
+  with zfp:
+    return UpdateDevice(args, zfp)
+
+
+def UpdateDevice(args, zfp):
+  """Apply the update described by the command line |args|.
+
+  Args:
+    args: the parsed command line arguments.
+    zfp: the OTA package opened as a zipfile.ZipFile, or None when otafile is
+        a raw payload.
+
+  Returns:
+    the exit code of the script.
+  """
   dut = AdbHost(args.s)
 
   server_thread = None
@@ -456,7 +586,7 @@ def main():
 
   metadata_path = "/data/ota_package/metadata"
   if args.allocate_only:
-    if PushMetadata(dut, args.otafile, metadata_path):
+    if PushMetadata(dut, zfp, metadata_path):
       dut.adb([
           "shell", "update_engine_client", "--allocate",
           "--metadata={}".format(metadata_path)])
@@ -464,7 +594,7 @@ def main():
     # this point
     return 0
   if args.verify_only:
-    if PushMetadata(dut, args.otafile, metadata_path):
+    if PushMetadata(dut, zfp, metadata_path):
       dut.adb([
           "shell", "update_engine_client", "--verify",
           "--metadata={}".format(metadata_path)])
@@ -472,56 +602,61 @@ def main():
     # this point
     return 0
 
+  extra_headers = [args.extra_headers]
   if args.no_slot_switch:
-    args.extra_headers += "\nSWITCH_SLOT_ON_REBOOT=0"
+    extra_headers.append("SWITCH_SLOT_ON_REBOOT=0")
   if args.no_postinstall:
-    args.extra_headers += "\nRUN_POST_INSTALL=0"
-
-  with zipfile.ZipFile(args.otafile) as zfp:
-    CARE_MAP_ENTRY_NAME = "care_map.pb"
-    if CARE_MAP_ENTRY_NAME in zfp.namelist() and not args.no_care_map:
-      # Need root permission to push to /data
-      dut.adb(["root"])
-      with tempfile.NamedTemporaryFile() as care_map_fp:
-        care_map_fp.write(zfp.read(CARE_MAP_ENTRY_NAME))
-        care_map_fp.flush()
-        dut.adb(["push", care_map_fp.name,
-                "/data/ota_package/" + CARE_MAP_ENTRY_NAME])
+    extra_headers.append("RUN_POST_INSTALL=0")
+  args.extra_headers = "\n".join(filter(None, extra_headers))
+
+  CARE_MAP_ENTRY_NAME = "care_map.pb"
+  if (zfp and CARE_MAP_ENTRY_NAME in zfp.namelist() and
+      not args.no_care_map):
+    # Need root permission to push to /data
+    dut.adb(["root"])
+    with tempfile.TemporaryDirectory() as tmpdir:
+      # extract() streams the entry instead of reading it all into memory.
+      care_map_path = zfp.extract(CARE_MAP_ENTRY_NAME, tmpdir)
+      dut.adb(["push", care_map_path,
+              "/data/ota_package/" + CARE_MAP_ENTRY_NAME])
 
   if args.file:
     # Update via pushing a file to /data.
     device_ota_file = os.path.join(OTA_PACKAGE_PATH, 'debug.zip')
     payload_url = 'file://' + device_ota_file
+    # Run the post-push steps in a single root shell to pay the adb round trip
+    # only once.
+    shell_cmds = []
     if not args.no_push:
       data_local_tmp_file = '/data/local/tmp/debug.zip'
       cmds.append(['push', args.otafile, data_local_tmp_file])
-      cmds.append(['shell', 'su', '0', 'mv', data_local_tmp_file,
-                   device_ota_file])
-      cmds.append(['shell', 'su', '0', 'chcon',
-                   'u:object_r:ota_package_file:s0', device_ota_file])
-    cmds.append(['shell', 'su', '0', 'chown', 'system:cache', device_ota_file])
-    cmds.append(['shell', 'su', '0', 'chmod', '0660', device_ota_file])
+      shell_cmds.append('mv %s %s' % (data_local_tmp_file, device_ota_file))
+      shell_cmds.append('chcon u:object_r:ota_package_file:s0 %s' %
+                        device_ota_file)
+    shell_cmds.append('chown system:cache %s' % device_ota_file)
+    shell_cmds.append('chmod 0660 %s' % device_ota_file)
+    cmds.append(RootShellCommand(shell_cmds))
   else:
     # Update via sending the payload over the network with an "adb reverse"
     # command.
     payload_url = 'http://127.0.0.1:%d/payload' % DEVICE_PORT
-    if use_omaha and zipfile.is_zipfile(args.otafile):
-      ota = AndroidOTAPackage(args.otafile, args.secondary)
+    ota_stat = os.stat(args.otafile)
+    if use_omaha and zfp:
+      ota = AndroidOTAPackage(args.otafile, args.secondary, zfp)
       serving_range = (ota.offset, ota.size)
     else:
-      serving_range = (0, os.stat(args.otafile).st_size)
-    server_thread = StartServer(args.otafile, serving_range)
+      serving_range = (0, ota_stat.st_size)
+    server_thread = StartServer(args.otafile, serving_range, ota_stat)
     cmds.append(
         ['reverse', 'tcp:%d' % DEVICE_PORT, 'tcp:%d' % server_thread.port])
     finalize_cmds.append(['reverse', '--remove', 'tcp:%d' % DEVICE_PORT])
 
   if args.public_key:
     payload_key_dir = os.path.dirname(PAYLOAD_KEY_PATH)
-    cmds.append(
-        ['shell', 'su', '0', 'mount', '-t', 'tmpfs', 'tmpfs', payload_key_dir])
-    # Allow adb push to payload_key_dir
-    cmds.append(['shell', 'su', '0', 'chcon', 'u:object_r:shell_data_file:s0',
-                 payload_key_dir])
+    # Mount a tmpfs over payload_key_dir and allow adb push to it.
+    cmds.append(RootShellCommand([
+        'mount -t tmpfs tmpfs %s' % payload_key_dir,
+        'chcon u:object_r:shell_data_file:s0 %s' % payload_key_dir]))
     cmds.append(['push', args.public_key, PAYLOAD_KEY_PATH])
     # Allow update_engine to read it.
     cmds.append(['shell', 'su', '0', 'chcon', '-R', 'u:object_r:system_file:s0',
@@ -535,7 +670,7 @@ def main():
           OmahaUpdateCommand('http://127.0.0.1:%d/update' % DEVICE_PORT)
     else:
       update_cmd = AndroidUpdateCommand(args.otafile, args.secondary,
-                                        payload_url, args.extra_headers)
+                                        payload_url, args.extra_headers, zfp)
     cmds.append(['shell', 'su', '0'] + update_cmd)
 
     for cmd in cmds:
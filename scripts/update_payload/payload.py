@@ -119,10 +119,13 @@ class Payload(object):
     """Initialize the payload object.
 
     Args:
-      payload_file: update payload file object open for reading
+      payload_file: update payload file object open for reading, path to a
+          payload or OTA package, or an open OTA package zipfile.ZipFile
       payload_file_offset: the offset of the actual payload
     """
-    if zipfile.is_zipfile(payload_file):
+    if isinstance(payload_file, zipfile.ZipFile):
+      self.payload_file = payload_file.open("payload.bin", "r")
+    elif zipfile.is_zipfile(payload_file):
       with zipfile.ZipFile(payload_file) as zfp:
         self.payload_file = zfp.open("payload.bin", "r")
     elif isinstance(payload_file, str):